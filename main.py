@@ -1,27 +1,91 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from contextlib import asynccontextmanager
+from fastapi.responses import Response, StreamingResponse
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime
-from bson import ObjectId
-import io
+from concurrent.futures import ThreadPoolExecutor
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+from gridfs.errors import NoFile
+from cryptography.exceptions import InvalidTag
+import asyncio
+import hmac
+import logging
 import os
+import re
+import stat
+import time
+import uuid
 import uvicorn
 
 from database import connect_db, close_db, get_db, get_fs
-from quantum_engine import quantum_encrypt, quantum_decrypt
+from quantum_engine import (
+    HEADER_SIZES,
+    QuantumEncryptor,
+    QuantumDecryptor,
+    derive_key,
+    encrypted_size,
+    generate_entropy_fingerprint,
+    key_check
+)
 from models import EncryptedFileResponse
 
+log = logging.getLogger(__name__)
+
+# Upload read size; bounds per-request memory regardless of file size.
+CHUNK_SIZE = 1 << 20
+
+# Measured in UTF-8 bytes, not codepoints
+MIN_PASSWORD_BYTES = 8
+
+# Encrypted blobs up to this size are stored inline in the files document
+# instead of GridFS. BSON documents are capped at 16 MiB, so the setting
+# is clamped to leave 1 MiB for the metadata fields; a larger value would
+# only fail at insert_one, after the whole upload was encrypted.
+INLINE_LIMIT_BYTES = 15 * 1024 * 1024
+INLINE_MAX_BYTES = min(
+    int(os.getenv("INLINE_MAX_BYTES", INLINE_LIMIT_BYTES)),
+    INLINE_LIMIT_BYTES
+)
+
+# Behind nginx, hand decrypted files over via X-Accel-Redirect so nginx
+# sends them with sendfile(2) instead of through ASGI. Needs e.g.
+#   location /_internal/ { internal; alias /tmp/qtdfp/; }
+# The directory holds plaintext: it is created 0750 with files 0640, so
+# nginx must share this process's group (or the directory's, if setgid).
+X_ACCEL_ENABLED = os.getenv("X_ACCEL_ENABLED", "").lower() in ("1", "true", "yes")
+X_ACCEL_DIR = os.getenv("X_ACCEL_DIR", "/tmp/qtdfp")
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX", "/_internal/")
+# Decrypted files older than this (seconds) are removed by a background
+# sweep every X_ACCEL_SWEEP_INTERVAL seconds
+X_ACCEL_TTL = int(os.getenv("X_ACCEL_TTL", 300))
+X_ACCEL_SWEEP_INTERVAL = 30
+# Files are named prefix + uuid hex; the sweep touches nothing else
+X_ACCEL_FILE_PREFIX = "qtdfp-"
+X_ACCEL_NAME = re.compile(re.escape(X_ACCEL_FILE_PREFIX) + "[0-9a-f]{32}")
 
 
 # =========================
-# LIFESPAN (DB CONNECT)
+# LIFESPAN (DB CONNECT + CPU POOL)
 # =========================
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await connect_db()
+    # Everything run here releases the GIL: PBKDF2 and AES-GCM (OpenSSL
+    # via cryptography) for new files, the nogil Numba kernels for
+    # format 1, plus blocking file I/O. Threads therefore run it in
+    # parallel without blocking the event loop.
+    app.state.cpu_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+    if X_ACCEL_ENABLED:
+        await run_cpu(_prepare_accel_dir)
+        sweeper = asyncio.create_task(_accel_sweeper())
     yield
+    if X_ACCEL_ENABLED:
+        sweeper.cancel()
+        with suppress(asyncio.CancelledError):
+            await sweeper
+    app.state.cpu_pool.shutdown()
     await close_db()
 
 
@@ -44,6 +108,42 @@ app.add_middleware(
 )
 
 
+# =========================
+# HELPERS
+# =========================
+
+async def run_cpu(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.cpu_pool, fn, *args)
+
+
+def _password_ok(password: str) -> bool:
+    return len(password.encode("utf-8")) >= MIN_PASSWORD_BYTES
+
+
+def _object_id(file_id: str) -> ObjectId:
+    try:
+        return ObjectId(file_id)
+    except InvalidId:
+        raise HTTPException(404, "File not found")
+
+
+def _unlock(meta: dict, password: str) -> bytes | None:
+    # Format 2: derive the AES key from the stored salt and compare its
+    # key check. Legacy files only have the unsalted chaotic fingerprint.
+    # Returns the format 2 key (None for legacy files).
+    if meta.get("version", 1) == 2:
+        key = derive_key(password, meta["salt"])
+        check, expected = key_check(key), meta["key_check"]
+    else:
+        key = None
+        check, expected = generate_entropy_fingerprint(password), meta["fingerprint"]
+
+    if not hmac.compare_digest(check, expected):
+        raise HTTPException(401, "Wrong password")
+    return key
+
+
 # =========================
 # HEALTH CHECK
 # =========================
@@ -61,46 +161,75 @@ async def root():
 # ENCRYPT ENDPOINT
 # =========================
 
+async def _encrypt_chunks(file: UploadFile, encryptor: QuantumEncryptor, original_size: int):
+    yield encryptor.header
+
+    read = 0
+    while chunk := await file.read(CHUNK_SIZE):
+        read += len(chunk)
+        yield await run_cpu(encryptor.update, chunk)
+
+    if read != original_size:
+        raise HTTPException(400, "Upload size mismatch")
+
+
 @app.post("/api/encrypt", response_model=EncryptedFileResponse)
 async def encrypt_file(
     file: UploadFile = File(...),
     password: str = Form(...)
 ):
-    if not password or len(password) < 8:
-        raise HTTPException(400, "Password must be at least 8 characters")
+    # Rejected before any upload chunk is read or key is derived
+    if not _password_ok(password):
+        raise HTTPException(400, "Password must be at least 8 bytes")
 
-    data = await file.read()
-    if not data:
+    original_size = file.size
+    if not original_size:
         raise HTTPException(400, "Empty file")
 
-    encrypted, fingerprint, hash_val = quantum_encrypt(data, password)
+    # Key derivation (PBKDF2) is CPU-bound too
+    encryptor = await run_cpu(QuantumEncryptor, password, original_size)
 
     fs = get_fs()
     db = get_db()
 
-    # Store encrypted binary in GridFS
-    file_id = await fs.upload_from_stream(
-        file.filename,
-        io.BytesIO(encrypted)
-    )
-
-    # Store metadata separately
-    await db.files.insert_one({
+    file_id = ObjectId()
+    doc = {
         "_id": file_id,
         "filename": file.filename,
-        "fingerprint": fingerprint,
-        "hash": hash_val,
-        "original_size": len(data),
-        "encrypted_size": len(encrypted),
+        "salt": Binary(encryptor.salt),
+        "key_check": encryptor.key_check,
+        "version": encryptor.version,
+        "original_size": original_size,
+        "encrypted_size": encrypted_size(original_size),
         "created_at": datetime.utcnow()
-    })
+    }
+
+    if doc["encrypted_size"] <= INLINE_MAX_BYTES:
+        # Small file: ciphertext and metadata in one document, one write
+        doc["inline"] = True
+        doc["data"] = Binary(b"".join([
+            chunk async for chunk in _encrypt_chunks(file, encryptor, original_size)
+        ]))
+    else:
+        # Stream encrypted chunks into GridFS as they are produced; the
+        # filename lives only in the metadata document
+        grid_in = fs.open_upload_stream_with_id(file_id, str(file_id))
+        try:
+            async for chunk in _encrypt_chunks(file, encryptor, original_size):
+                await grid_in.write(chunk)
+            await grid_in.close()
+        except BaseException:
+            await grid_in.abort()
+            raise
+
+    await db.files.insert_one(doc)
 
     return EncryptedFileResponse(
         id=str(file_id),
         filename=file.filename,
-        original_size=len(data),
-        encrypted_size=len(encrypted),
-        created_at=datetime.utcnow()
+        original_size=original_size,
+        encrypted_size=doc["encrypted_size"],
+        created_at=doc["created_at"]
     )
 
 
@@ -109,76 +238,211 @@ async def encrypt_file(
 # =========================
 
 @app.get("/api/files")
-async def list_files():
+async def list_files(limit: int = Query(200, ge=1, le=1000)):
     """
     Optional: used only if frontend wants to show DB files.
     Safe to keep even if not used.
     """
     db = get_db()
-    files = []
 
-    async for doc in db.files.find().sort("created_at", -1):
-        files.append({
+    docs = await db.files.find(
+        {},
+        {
+            "filename": 1,
+            "original_size": 1,
+            "encrypted_size": 1,
+            "created_at": 1
+        }
+    ).sort(
+        [("created_at", -1), ("_id", 1)]
+    ).limit(limit).to_list(length=limit)
+
+    return [
+        {
             "id": str(doc["_id"]),
             "filename": doc["filename"],
             "original_size": doc["original_size"],
             "encrypted_size": doc["encrypted_size"],
             "created_at": doc["created_at"]
-        })
-
-    return files
+        }
+        for doc in docs
+    ]
 
 
 # =========================
 # DECRYPT ENDPOINT
 # =========================
 
+async def _inline_chunks(body: memoryview):
+    for i in range(0, len(body), CHUNK_SIZE):
+        yield body[i:i + CHUNK_SIZE]
+
+
+async def _decrypt_stream(chunks, decryptor: QuantumDecryptor, expected_hash: str | None):
+    # Headers are already sent; on tampering (InvalidTag) or a failed
+    # check the stream is aborted, leaving the client with a short body
+    # instead of silently corrupted data.
+    async for chunk in chunks:
+        yield await run_cpu(decryptor.update, chunk)
+
+    if not decryptor.verify(expected_hash):
+        raise RuntimeError("Decryption failed: wrong password or corrupted data")
+
+
+def _prepare_accel_dir():
+    try:
+        os.mkdir(X_ACCEL_DIR, 0o750)
+    except FileExistsError:
+        # Refuse a pre-existing directory others could read or plant
+        # files in (e.g. created by another user under /tmp)
+        st = os.lstat(X_ACCEL_DIR)
+        if (
+            not stat.S_ISDIR(st.st_mode)
+            or st.st_uid != os.getuid()
+            or st.st_mode & 0o007
+        ):
+            raise RuntimeError(
+                f"{X_ACCEL_DIR} must be a directory owned by this user "
+                "with no access for others"
+            )
+
+
+def _sweep_accel_dir(max_age: float):
+    cutoff = time.time() - max_age
+    for entry in os.scandir(X_ACCEL_DIR):
+        if not X_ACCEL_NAME.fullmatch(entry.name):
+            continue
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+async def _accel_sweeper():
+    while True:
+        await asyncio.sleep(X_ACCEL_SWEEP_INTERVAL)
+        try:
+            await run_cpu(_sweep_accel_dir, X_ACCEL_TTL)
+        except Exception:
+            # Keep the task alive; the sweep is retried on the next tick
+            log.exception("Sweeping %s failed", X_ACCEL_DIR)
+
+
+def _open_accel_file(path: str):
+    # O_EXCL: never write through a planted file or symlink
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+    return os.fdopen(fd, "wb")
+
+
+async def _decrypt_to_file(chunks, decryptor: QuantumDecryptor, expected_hash: str | None) -> str:
+    name = X_ACCEL_FILE_PREFIX + uuid.uuid4().hex
+    path = os.path.join(X_ACCEL_DIR, name)
+    out = await run_cpu(_open_accel_file, path)
+
+    # Unlike the streaming path, the whole file is verified before any
+    # byte reaches the client
+    try:
+        try:
+            async for chunk in _decrypt_stream(chunks, decryptor, expected_hash):
+                await run_cpu(out.write, chunk)
+        finally:
+            await run_cpu(out.close)
+    except (RuntimeError, InvalidTag, ValueError):
+        await run_cpu(os.remove, path)
+        raise HTTPException(
+            status_code=400,
+            detail="Decryption failed: wrong password or corrupted data"
+        )
+    except BaseException:
+        await run_cpu(os.remove, path)
+        raise
+
+    return name
+
+
 @app.post("/api/decrypt/{file_id}")
 async def decrypt_file(
     file_id: str,
     password: str = Form(...)
 ):
-    if not password or len(password) < 8:
+    if not _password_ok(password):
         raise HTTPException(400, "Invalid password")
 
     db = get_db()
     fs = get_fs()
+    oid = _object_id(file_id)
 
-    # 1️⃣ Fetch metadata
-    meta = await db.files.find_one({"_id": ObjectId(file_id)})
+    # 1️⃣ Fetch metadata only; inline ciphertext stays in the database
+    meta = await db.files.find_one({"_id": oid}, {"data": 0})
     if not meta:
         raise HTTPException(404, "File not found")
 
-    # 2️⃣ Download encrypted binary from GridFS
-    encrypted_buffer = io.BytesIO()
-    await fs.download_to_stream(ObjectId(file_id), encrypted_buffer)
-    encrypted_buffer.seek(0)
-    encrypted_data = encrypted_buffer.read()
+    # 2️⃣ Check password before any ciphertext is fetched; a wrong
+    #    password costs one small lookup and a key derivation
+    #    (metadata without a version predates it)
+    version = meta.get("version", 1)
+    header_size = HEADER_SIZES.get(version)
+    if not header_size:
+        raise HTTPException(400, "Encrypted data corrupted")
+    key = await run_cpu(_unlock, meta, password)
+
+    # 3️⃣ Fetch the inline blob or open the GridFS stream (file doc
+    #    only, no chunks read yet), then read the blob header
+    if meta.get("inline"):
+        doc = await db.files.find_one({"_id": oid}, {"data": 1})
+        if not doc or "data" not in doc:
+            raise HTTPException(404, "File not found")
+        blob = doc["data"]
+        blob_size = len(blob)
+    else:
+        try:
+            grid_out = await fs.open_download_stream(oid)
+        except NoFile:
+            raise HTTPException(404, "File not found")
+        blob_size = grid_out.length
+
+    if blob_size <= header_size:
+        raise HTTPException(400, "Encrypted data corrupted")
 
-    if not encrypted_data or len(encrypted_data) < 8:
+    if meta.get("inline"):
+        header = blob[:header_size]
+        chunks = _inline_chunks(memoryview(blob)[header_size:])
+    else:
+        header = await grid_out.read(header_size)
+        chunks = grid_out
+
+    try:
+        decryptor = QuantumDecryptor(password, header, version, key)
+    except ValueError:
         raise HTTPException(400, "Encrypted data corrupted")
 
-    # 3️⃣ Quantum decrypt (binary-safe)
-    decrypted = quantum_decrypt(
-        encrypted=encrypted_data,
-        password=password,
-        expected_fingerprint=meta["fingerprint"],
-        expected_hash=meta["hash"]
-    )
+    # A format 2 blob's size follows from its header; reject a truncated
+    # or padded one before any response header is sent
+    if version == 2 and blob_size != encrypted_size(decryptor.length):
+        raise HTTPException(400, "Encrypted data corrupted")
 
-    if decrypted is None:
-        raise HTTPException(
-            status_code=400,
-            detail="Decryption failed: wrong password or corrupted data"
+    disposition = f'attachment; filename="{meta["filename"]}"'
+
+    # 4️⃣a Decrypt to a temp file and let nginx serve it
+    if X_ACCEL_ENABLED:
+        name = await _decrypt_to_file(chunks, decryptor, meta.get("hash"))
+        # nginx sets Content-Length from the file; the upstream body is empty
+        return Response(
+            media_type="application/octet-stream",
+            headers={
+                "X-Accel-Redirect": X_ACCEL_PREFIX + name,
+                "Content-Disposition": disposition
+            }
         )
 
-    # 4️⃣ Stream back original file (NO MODIFICATION)
+    # 4️⃣b Quantum decrypt chunk by chunk while streaming to the client
     return StreamingResponse(
-        io.BytesIO(decrypted),
+        _decrypt_stream(chunks, decryptor, meta.get("hash")),
         media_type="application/octet-stream",
         headers={
-            "Content-Disposition": f'attachment; filename="{meta["filename"]}"',
-            "Content-Length": str(len(decrypted))
+            "Content-Disposition": disposition,
+            "Content-Length": str(decryptor.length)
         }
     )
 
@@ -191,14 +455,23 @@ async def decrypt_file(
 async def delete_file(file_id: str):
     db = get_db()
     fs = get_fs()
+    oid = _object_id(file_id)
 
-    try:
-        await fs.delete(ObjectId(file_id))
-        await db.files.delete_one({"_id": ObjectId(file_id)})
-        return {"status": "deleted"}
-    except Exception:
+    # Inline files have no GridFS entry, so NoFile alone is not a miss
+    result, fs_result = await asyncio.gather(
+        db.files.delete_one({"_id": oid}),
+        fs.delete(oid),
+        return_exceptions=True
+    )
+    if isinstance(result, BaseException):
+        raise result
+    if isinstance(fs_result, BaseException) and not isinstance(fs_result, NoFile):
+        raise fs_result
+    if not result.deleted_count and isinstance(fs_result, NoFile):
         raise HTTPException(404, "File not found")
 
+    return {"status": "deleted"}
+
 
 # =========================
 # LOCAL RUN (OPTIONAL)
@@ -1,17 +1,77 @@
 
+import hashlib
+import hmac
+import os
 import struct
-from typing import Generator, Tuple
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from numba import njit
+
+# =============================
+# BLOB FORMAT
+# =============================
+
+# 1: ">I" length header, one chaotic keystream over the whole payload.
+# 2: ">BI16s" version + length + salt header, AES-256-GCM segments.
+# Only the latest version is written; format 1 stays decryptable.
+FORMAT_VERSION = 2
+HEADER_SIZES = {1: 4, 2: 21}
+
+SALT_SIZE = 16
+TAG_SIZE = 16
+SEGMENT_SIZE = 1 << 16
+PBKDF2_ITERATIONS = 200_000
+
+def _pack_header(version: int, length: int, salt: bytes = b"") -> bytes:
+    if version == 1:
+        return struct.pack(">I", length)
+    return struct.pack(">BI", version, length) + salt
+
+def _unpack_header(version: int, header: bytes) -> int:
+    if version == 1:
+        return struct.unpack(">I", header)[0]
+
+    stored_version, length = struct.unpack(">BI", header[:5])
+    if stored_version != version:
+        raise ValueError(f"Header version {stored_version}, expected {version}")
+    return length
+
+def encrypted_size(length: int) -> int:
+    segments = -(-length // SEGMENT_SIZE)
+    return HEADER_SIZES[FORMAT_VERSION] + length + segments * TAG_SIZE
 
 # =============================
 # CHAOTIC MAPS
 # =============================
 
-def logistic_map(x: float, r: float = 3.99) -> float:
+LOGISTIC_R = 3.99
+TENT_MU = 1.99
+
+def logistic_map(x: float, r: float = LOGISTIC_R) -> float:
     return r * x * (1 - x)
 
-def tent_map(x: float, mu: float = 1.99) -> float:
+def tent_map(x: float, mu: float = TENT_MU) -> float:
     return mu * x if x < 0.5 else mu * (1 - x)
 
+# Kernel versions with r and mu fixed. Numba freezes module globals as
+# compile-time constants and inlines these into each loop, so the inner
+# loops carry literal operands. Evaluation order matches logistic_map
+# (no fastmath/FMA contraction) to keep stored ciphertexts decryptable.
+
+@njit(cache=True, nogil=True, inline="always")
+def _logistic_step(x):
+    return LOGISTIC_R * x * (1.0 - x)
+
+@njit(cache=True, nogil=True, inline="always")
+def _tent_step(y):
+    return TENT_MU * min(y, 1.0 - y)
+
 # =============================
 # PASSWORD → SEED
 # =============================
@@ -25,97 +85,314 @@ def generate_entropy_seed(password: str) -> float:
     return max(0.0001, min(0.9999, seed))
 
 # =============================
-# ENTROPY STREAM
+# WARM STATE
 # =============================
 
-def entropy_stream(seed: float, length: int) -> Generator[int, None, None]:
+@njit(cache=True, nogil=True)
+def _warmup(seed):
     x = seed
-    y = tent_map(seed)
+    y = _tent_step(seed)
 
     for _ in range(100):
-        x = logistic_map(x)
-        y = tent_map(y)
+        x = _logistic_step(x)
+        y = _tent_step(y)
+
+    return x, y
 
-    for _ in range(length):
-        x = logistic_map(x)
-        y = tent_map(y)
-        yield int(((x + y) / 2) * 256) & 0xFF
+@lru_cache(maxsize=1024)
+def _warm_state(password: str) -> Tuple[float, float]:
+    # Every keystream consumer starts from the same post-warmup (x, y),
+    # so run the 100 discarded iterations once per password.
+    return _warmup(generate_entropy_seed(password))
+
+# =============================
+# ENTROPY STREAM
+# =============================
+
+@njit(cache=True, nogil=True)
+def _keystream(x, y, n, out):
+    # logistic_map + tent_map per byte; kept free of fastmath so the
+    # chaotic trajectory (and thus existing ciphertexts) is bit-exact.
+    for i in range(n):
+        x = _logistic_step(x)
+        y = _tent_step(y)
+        out[i] = int(((x + y) / 2) * 256) & 0xFF
+
+    return x, y
+
+def entropy_bytes(x: float, y: float, length: int) -> bytes:
+    out = np.empty(length, np.uint8)
+    _keystream(x, y, length, out)
+    return out.tobytes()
 
 # =============================
 # FINGERPRINT
 # =============================
 
+@lru_cache(maxsize=2048)
 def generate_entropy_fingerprint(password: str) -> str:
-    seed = generate_entropy_seed(password)
-    stream = entropy_stream(seed, 32)
-    return ''.join(f"{next(stream):02x}" for _ in range(32))
+    x, y = _warm_state(password)
+    return entropy_bytes(x, y, 32).hex()
 
 # =============================
 # HASH
 # =============================
 
-def quantum_hash(data: bytes, password: str) -> str:
-    seed = generate_entropy_seed(password)
-    state = bytearray(32)
+# Per-byte logistic step of the hash, precomputed for every state value.
+_LOG_LUT = np.array(
+    [int(logistic_map(s / 256) * 127) & 0xFF for s in range(256)],
+    np.uint8
+)
+
+@njit(cache=True, nogil=True)
+def _qhash(data, state):
+    for i in range(data.size):
+        p = i & 31
+        state[p] ^= data[i]
+        state[p] = (state[p] + _LOG_LUT[state[p]]) & 0xFF
+
+@njit(cache=True, nogil=True)
+def _xor_and_hash(data, x, y, state, out, pos):
+    # One pass: XOR ciphertext with the keystream and fold each
+    # ciphertext byte into the hash state at blob offset pos + i.
+    for i in range(data.size):
+        x = _logistic_step(x)
+        y = _tent_step(y)
+        out[i] = data[i] ^ (int(((x + y) / 2) * 256) & 0xFF)
+
+        p = (pos + i) & 31
+        state[p] ^= data[i]
+        state[p] = (state[p] + _LOG_LUT[state[p]]) & 0xFF
+
+    return x, y
+
+# =============================
+# CHAOTIC DECRYPT (FORMAT 1)
+# =============================
+
+class _ChaoticDecryptor:
+    """Keystream + rolling hash state for the legacy chaotic format."""
+
+    def __init__(self, password: str, header: bytes):
+        self._x, self._y = _warm_state(password)
+
+        self._state = np.empty(32, np.uint8)
+        _keystream(self._x, self._y, 32, self._state)
+        _qhash(np.frombuffer(header, np.uint8), self._state)
+        self._offset = len(header)
+        self._pos = 0
+
+    def update(self, chunk: bytes) -> np.ndarray:
+        data = np.frombuffer(chunk, np.uint8)
+        out = np.empty(data.size, np.uint8)
+        pos = self._offset + self._pos
+
+        self._x, self._y = _xor_and_hash(
+            data, self._x, self._y, self._state, out, pos
+        )
 
-    stream = entropy_stream(seed, 32)
-    for i in range(32):
-        state[i] = next(stream)
+        self._pos += data.size
+        return out
 
-    for i, b in enumerate(data):
-        p = i % 32
-        state[p] ^= b
-        state[p] = (state[p] + int(logistic_map(state[p] / 256) * 127)) & 0xFF
+    def hexdigest(self) -> str:
+        return self._state.tobytes().hex()
 
-    return state.hex()
+# =============================
+# AES-GCM SEGMENTS (FORMAT 2)
+# =============================
+
+def derive_key(password: str, salt: bytes) -> bytes:
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=PBKDF2_ITERATIONS
+    )
+    return kdf.derive(password.encode("utf-8"))
+
+def key_check(key: bytes) -> str:
+    # Stored in place of the chaotic fingerprint: as costly to brute-force
+    # as the key itself, and exact, so a match means the stream will open.
+    return hmac.new(key, b"verify", hashlib.sha256).hexdigest()
+
+def _segment_nonce(index: int, last: bool) -> bytes:
+    # Keys are unique per file (random salt), so a counter is a safe
+    # nonce; the final flag stops truncation at a segment boundary.
+    return index.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+class _SegmentCipher:
+    """
+    Splits a stream into SEGMENT_SIZE plaintext segments, each sealed
+    with AES-256-GCM and the blob header as associated data.
+    """
+
+    def __init__(self, key: bytes, header: bytes, length: int):
+        self._aead = AESGCM(key)
+        self._header = header
+        self._length = length
+        self._pending = b""
+        self._index = 0
+        self._pos = 0
+
+    def _process(self, chunk: bytes, overhead: int, seal: bool) -> bytes:
+        data = memoryview(self._pending + chunk) if self._pending else memoryview(chunk)
+        out = []
+        start = 0
+
+        while self._pos < self._length:
+            n = min(SEGMENT_SIZE, self._length - self._pos)
+            if len(data) - start < n + overhead:
+                break
+
+            last = self._pos + n >= self._length
+            nonce = _segment_nonce(self._index, last)
+            segment = data[start:start + n + overhead]
+            if seal:
+                out.append(self._aead.encrypt(nonce, segment, self._header))
+            else:
+                out.append(self._aead.decrypt(nonce, segment, self._header))
+
+            start += n + overhead
+            self._index += 1
+            self._pos += n
+
+        self._pending = bytes(data[start:])
+        if self._pos >= self._length and self._pending:
+            raise ValueError("Data past the declared length")
+        return b"".join(out)
+
+    def encrypt(self, chunk: bytes) -> bytes:
+        return self._process(chunk, 0, True)
+
+    def decrypt(self, chunk: bytes) -> bytes:
+        return self._process(chunk, TAG_SIZE, False)
+
+    @property
+    def done(self) -> bool:
+        return self._pos >= self._length
 
 # =============================
 # ENCRYPT
 # =============================
 
-def quantum_encrypt(data: bytes, password: str) -> Tuple[bytes, str, str]:
-    seed = generate_entropy_seed(password)
-    fingerprint = generate_entropy_fingerprint(password)
+class QuantumEncryptor:
+    """
+    Incremental quantum_encrypt: feed the plaintext through update() in
+    chunks of any size; header + update(...) + ... is the complete blob
+    once `length` bytes have been fed.
+    """
 
-    encrypted = bytearray()
-    encrypted.extend(struct.pack(">I", len(data)))
+    def __init__(self, password: str, length: int):
+        self.version = FORMAT_VERSION
+        self.salt = os.urandom(SALT_SIZE)
+        key = derive_key(password, self.salt)
+        self.key_check = key_check(key)
+        self.header = _pack_header(FORMAT_VERSION, length, self.salt)
+        self._cipher = _SegmentCipher(key, self.header, length)
 
-    stream = entropy_stream(seed, len(data))
-    for b, k in zip(data, stream):
-        encrypted.append(b ^ k)
+    def update(self, chunk: bytes) -> bytes:
+        return self._cipher.encrypt(chunk)
 
-    encrypted_bytes = bytes(encrypted)
-    hash_val = quantum_hash(encrypted_bytes, password)
+def quantum_encrypt(data: bytes, password: str) -> Tuple[bytes, str]:
+    encryptor = QuantumEncryptor(password, len(data))
+    encrypted_bytes = encryptor.header + encryptor.update(data)
 
-    return encrypted_bytes, fingerprint, hash_val
+    return encrypted_bytes, encryptor.key_check
 
 # =============================
 # DECRYPT
 # =============================
 
+class QuantumDecryptor:
+    """
+    Incremental quantum_decrypt, built from the blob header of the given
+    format version. Format 2 only returns authenticated plaintext and
+    raises InvalidTag on tampering; for format 1 plaintext is
+    unverified until verify() succeeds after the last chunk. A format 2
+    key already derived (and checked) by the caller skips PBKDF2.
+    """
+
+    def __init__(
+        self,
+        password: str,
+        header: bytes,
+        version: int = FORMAT_VERSION,
+        key: bytes | None = None
+    ):
+        self.version = version
+        self.length = _unpack_header(version, header)
+
+        if version == 2:
+            if key is None:
+                key = derive_key(password, header[-SALT_SIZE:])
+            self._cipher = _SegmentCipher(key, header, self.length)
+        else:
+            self._cipher = _ChaoticDecryptor(password, header)
+        self._pos = 0
+
+    def update(self, chunk: bytes) -> bytes:
+        if self.version == 2:
+            return self._cipher.decrypt(chunk)
+
+        # Bytes past the declared length are hashed but not returned
+        keep = max(0, min(len(chunk), self.length - self._pos))
+        self._pos += len(chunk)
+        return self._cipher.update(chunk)[:keep].tobytes()
+
+    def verify(self, expected_hash: str | None = None) -> bool:
+        if self.version == 2:
+            return self._cipher.done
+
+        return (
+            self._pos >= self.length
+            and self._cipher.hexdigest() == expected_hash
+        )
+
 def quantum_decrypt(
     encrypted: bytes,
     password: str,
-    expected_fingerprint: str,
-    expected_hash: str
+    expected_check: str,
+    expected_hash: str | None = None,
+    version: int = FORMAT_VERSION
 ) -> bytes | None:
-
-    if generate_entropy_fingerprint(password) != expected_fingerprint:
+    """
+    expected_check is the key check for format 2 and the chaotic
+    fingerprint for format 1.
+    """
+
+    header_size = HEADER_SIZES[version]
+    header = encrypted[:header_size]
+
+    key = None
+    if version == 2:
+        key = derive_key(password, header[-SALT_SIZE:])
+        check = key_check(key)
+    else:
+        check = generate_entropy_fingerprint(password)
+
+    if not hmac.compare_digest(check, expected_check):
         return None
 
-    if quantum_hash(encrypted, password) != expected_hash:
+    try:
+        decryptor = QuantumDecryptor(password, header, version, key)
+        decrypted = decryptor.update(memoryview(encrypted)[header_size:])
+    except (ValueError, struct.error, InvalidTag):
         return None
 
-    original_len = struct.unpack(">I", encrypted[:4])[0]
-
-    seed = generate_entropy_seed(password)
-    stream = entropy_stream(seed, original_len)
+    if not decryptor.verify(expected_hash):
+        return None
 
-    decrypted = bytearray()
-    for b, k in zip(encrypted[4:], stream):
-        decrypted.append(b ^ k)
+    return decrypted
 
-    if len(decrypted) != original_len:
-        return None
+# =============================
+# JIT WARMUP
+# =============================
 
-    return bytes(decrypted)
+# Pay the compile (or cache load) cost at import, not on the first request.
+_warmup(0.5)
+_keystream(0.5, 0.5, 1, np.empty(1, np.uint8))
+_qhash(np.frombuffer(b"\0", np.uint8), np.zeros(32, np.uint8))
+_xor_and_hash(
+    np.frombuffer(b"\0", np.uint8), 0.5, 0.5, np.zeros(32, np.uint8),
+    np.empty(1, np.uint8), 0
+)